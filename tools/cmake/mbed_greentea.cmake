@@ -49,7 +49,12 @@ macro(mbed_greentea_add_test)
 
     set(TEST_NAME ${MBED_GREENTEA_TEST_NAME})
 
-    add_subdirectory(${MBED_PATH} build)
+    # Guard the shared tree so several tests can be aggregated under one
+    # project without redefining its targets (CMP0002) or reusing the
+    # "build" binary directory.
+    if(NOT TARGET mbed-os)
+        add_subdirectory(${MBED_PATH} build)
+    endif()
 
     add_executable(${TEST_NAME})
 
@@ -0,0 +1,926 @@
+"""
+Copyright (c) 2021 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import fnmatch
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import selectors
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from pathlib import Path
+
+CMAKE_BUILD_DIR = "cmake_build"
+TEST_BINARY_PATTERN = "sdfx-arm-test-*.bin"
+BUILD_CACHE_FILE = ".greentea_build_cache.json"
+
+# Compiled once: scan_tree matches this against every file name in the
+# tree, and fnmatch would otherwise re-translate the pattern per call.
+_TEST_BINARY_RE = re.compile(fnmatch.translate(TEST_BINARY_PATTERN))
+
+log = logging.getLogger(__name__)
+
+
+class ReturnCode(Enum):
+    """Return codes."""
+
+    SUCCESS = 0
+    ERROR = 1
+    INVALID_OPTIONS = 2
+
+
+class ArgumentParserWithDefaultHelp(argparse.ArgumentParser):
+    """Subclass that always shows the help message on invalid arguments."""
+
+    def error(self, message):
+        """Error handler."""
+        sys.stderr.write("error: {}\n".format(message))
+        self.print_help()
+        raise SystemExit(ReturnCode.INVALID_OPTIONS.value)
+
+
+@dataclasses.dataclass(slots=True)
+class TreeScan:
+    """Paths of interest collected in a single walk of the tests tree."""
+
+    cmake_lists: list[str] = dataclasses.field(default_factory=list)
+    build_dirs: list[str] = dataclasses.field(default_factory=list)
+    binaries: list[str] = dataclasses.field(default_factory=list)
+
+
+def scan_tree(root_dir):
+    """Collect test CMakeLists, build directories and binaries in one pass.
+
+    Replaces one recursive glob per pattern, each of which walked the
+    whole tree and stat'ed every entry, with a single os.scandir walk.
+    """
+    scan = TreeScan()
+    stack = [(str(root_dir), False)]
+    while stack:
+        directory, in_build_dir = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    is_build_dir = entry.name == CMAKE_BUILD_DIR
+                    if is_build_dir and not in_build_dir:
+                        scan.build_dirs.append(entry.path)
+                    stack.append((entry.path, in_build_dir or is_build_dir))
+                elif entry.name == "CMakeLists.txt" and not in_build_dir:
+                    scan.cmake_lists.append(entry.path)
+                elif _TEST_BINARY_RE.match(entry.name):
+                    scan.binaries.append(entry.path)
+    return scan
+
+
+def default_jobs():
+    """Return the number of CPUs usable by this process.
+
+    sched_getaffinity respects cgroup CPU masks, so inside a container
+    or CI runner this reports what is actually schedulable rather than
+    the host's core count; cpu_count() is only the fallback for
+    platforms without it.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _child_environment(env=None):
+    """Return the environment for a child, with parallelism right-sized.
+
+    CMAKE_BUILD_PARALLEL_LEVEL makes any cmake --build run without an
+    explicit --parallel flag default to the usable CPU count instead
+    of a single job (or, on an oversubscribed runner, the host's).
+    """
+    child_env = dict(os.environ if env is None else env)
+    child_env.setdefault("CMAKE_BUILD_PARALLEL_LEVEL", str(default_jobs()))
+    return child_env
+
+
+def _spawn(cmd, env=None):
+    """Start a child process with its stdout piped, unbuffered.
+
+    The program is resolved on PATH first: CPython only takes its
+    posix_spawn fast path (no page-table duplication of this process)
+    when the executable carries a directory component, close_fds is
+    off and no pre-exec hooks are set. run_all spawns one mbedhtrun
+    per binary, so the cheaper startup adds up.
+    """
+    executable = shutil.which(cmd[0])
+    if executable:
+        cmd = [executable, *cmd[1:]]
+    return subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        bufsize=0,
+        close_fds=False,
+        env=_child_environment(env),
+    )
+
+
+def execute_forward(cmd, env=None):
+    """Execute a command, forwarding its output straight to stdout.
+
+    Where os.splice is available the bytes are moved from the child's
+    pipe to stdout by the kernel, without round-tripping through the
+    interpreter at all; otherwise a plain buffered copy is used.
+    """
+    sys.stdout.flush()
+    popen = _spawn(cmd, env=env)
+    try:
+        stdout_fd = sys.stdout.fileno()
+    except (OSError, ValueError):
+        # stdout has been replaced by something that is not a real file.
+        stdout_fd = None
+    try:
+        if stdout_fd is not None and hasattr(os, "splice"):
+            try:
+                while os.splice(popen.stdout.fileno(), stdout_fd, 1 << 20):
+                    pass
+            except OSError:
+                # splice() refuses some stdout targets; copy the rest
+                # the portable way.
+                shutil.copyfileobj(popen.stdout, sys.stdout.buffer, 1 << 16)
+        else:
+            shutil.copyfileobj(popen.stdout, sys.stdout.buffer, 1 << 16)
+    finally:
+        popen.stdout.close()
+    return_code = popen.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, cmd)
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_launcher():
+    """Return the first compiler cache available on PATH, if any."""
+    for launcher in ("ccache", "sccache"):
+        if shutil.which(launcher):
+            return launcher
+    return None
+
+
+def _configure_invocation(
+    binary_tree, build_dir, toolchain, profile, cache_base_dir=None
+):
+    """Return the configure command and environment."""
+    cmd = [
+        "cmake",
+        "-S",
+        str(binary_tree),
+        "-B",
+        str(build_dir),
+        "-GNinja",
+        f"-DMBED_TOOLCHAIN={toolchain}",
+        f"-DCMAKE_BUILD_TYPE={profile}",
+    ]
+    env = None
+    launcher = compiler_launcher()
+    if launcher:
+        cmd += [
+            f"-DCMAKE_C_COMPILER_LAUNCHER={launcher}",
+            f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}",
+            f"-DCMAKE_ASM_COMPILER_LAUNCHER={launcher}",
+        ]
+        # Relocate paths and relax hashing so the cache hits across
+        # the many sibling test directories that share headers.
+        env = dict(
+            os.environ,
+            CCACHE_BASEDIR=str(cache_base_dir or binary_tree),
+            CCACHE_SLOPPINESS="pch_defines,time_macros,include_file_mtime",
+        )
+    return cmd, env
+
+
+def run_configure_build_cmd(binary_tree, toolchain, profile, cache_base_dir=None):
+    """Configure the build system for a test directory."""
+    build_dir = Path(binary_tree, CMAKE_BUILD_DIR)
+    cmd, env = _configure_invocation(
+        binary_tree, build_dir, toolchain, profile, cache_base_dir
+    )
+    compiler_id_cache_dir = None
+    if cache_base_dir is not None:
+        compiler_id_cache_dir = _compiler_id_cache_dir(
+            cache_base_dir, toolchain, profile
+        )
+        _prime_compiler_id_results(build_dir, compiler_id_cache_dir)
+    log.debug("command: '%s'", cmd)
+    execute_forward(cmd, env=env)
+    if compiler_id_cache_dir is not None:
+        _store_compiler_id_results(build_dir, compiler_id_cache_dir)
+
+
+# Results of CMake's compiler-ID probes, identical for every project
+# built with the same toolchain and profile.
+_COMPILER_ID_FILES = (
+    "CMakeSystem.cmake",
+    "CMakeCCompiler.cmake",
+    "CMakeCXXCompiler.cmake",
+    "CMakeASMCompiler.cmake",
+)
+
+
+def _compiler_id_cache_dir(cache_base_dir, toolchain, profile):
+    """Return the shared compiler-ID cache directory for a build flavour."""
+    return Path(cache_base_dir, ".compiler_id_cache", f"{toolchain}-{profile}")
+
+
+def _prime_compiler_id_results(build_dir, cache_dir):
+    """Seed a build directory with cached compiler-ID results.
+
+    CMake's CMAKE_DETERMINE_* macros short-circuit when these files
+    already exist, skipping the try_compile probes that dominate
+    configure time for cross toolchains.
+    """
+    if not cache_dir.is_dir():
+        return
+    for version_dir in cache_dir.iterdir():
+        destination = Path(build_dir, "CMakeFiles", version_dir.name)
+        destination.mkdir(parents=True, exist_ok=True)
+        for file_name in _COMPILER_ID_FILES:
+            cached_file = version_dir.joinpath(file_name)
+            destination_file = destination.joinpath(file_name)
+            if cached_file.is_file() and not destination_file.exists():
+                shutil.copy2(cached_file, destination_file)
+
+
+def _store_compiler_id_results(build_dir, cache_dir):
+    """Record a configured build directory's compiler-ID results.
+
+    The files are staged and then renamed into place so concurrent
+    builds racing on the first configure cannot publish a partial
+    cache entry.
+    """
+    cmake_files_dir = Path(build_dir, "CMakeFiles")
+    if not cmake_files_dir.is_dir():
+        return
+    for version_dir in cmake_files_dir.glob("[0-9]*.[0-9]*"):
+        destination = cache_dir.joinpath(version_dir.name)
+        if destination.is_dir():
+            continue
+        staging = destination.with_name(f"{destination.name}.{os.getpid()}")
+        staging.mkdir(parents=True, exist_ok=True)
+        for file_name in _COMPILER_ID_FILES:
+            cached_file = version_dir.joinpath(file_name)
+            if cached_file.is_file():
+                shutil.copy2(cached_file, staging.joinpath(file_name))
+        try:
+            staging.rename(destination)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def cmake_cache_matches(build_dir, toolchain, profile):
+    """Check whether an existing CMake cache matches the requested build.
+
+    Cache entries are 'name:type=value' lines; the type is ignored, as
+    it depends on how the variable was first set (-D definitions with
+    no explicit type are recorded as UNINITIALIZED).
+    """
+    cmake_cache = Path(build_dir, "CMakeCache.txt")
+    if not cmake_cache.exists():
+        return False
+    wanted = {
+        "CMAKE_BUILD_TYPE": str(profile),
+        "MBED_TOOLCHAIN": str(toolchain),
+    }
+    cached = {}
+    with open(cmake_cache) as cache_file:
+        for line in cache_file:
+            line = line.strip()
+            if not line or line.startswith(("#", "//")):
+                continue
+            name_and_type, separator, value = line.partition("=")
+            if not separator:
+                continue
+            name = name_and_type.partition(":")[0]
+            if name in wanted:
+                cached[name] = value
+    return cached == wanted
+
+
+def _build_invocation(build_dir, jobs):
+    """Return the build command for a configured build directory."""
+    return ["cmake", "--build", str(build_dir), "--parallel", str(jobs)]
+
+
+def run_build_cmd(binary_tree, jobs):
+    """Build the artefacts for a previously configured test directory."""
+    cmd = _build_invocation(Path(binary_tree, CMAKE_BUILD_DIR), jobs)
+    log.debug("command: '%s'", cmd)
+    execute_forward(cmd)
+
+
+def _remove_directory(directory):
+    """Remove one directory tree, logging failures and carrying on."""
+    log.debug("Deleting: %s", directory)
+    shutil.rmtree(
+        directory,
+        onerror=lambda function, path, excinfo: log.warning(
+            f"Could not delete: {path}"
+        ),
+    )
+
+
+def remove_subdirectories_with_name(root_dir, name):
+    """Remove all subdirectories of a tree with a given name.
+
+    The removals are dispatched to a thread pool: deleting a build
+    tree is one unlink syscall per file, and overlapping the per-inode
+    latency across separate subtrees is an easy win.
+    """
+    matching_dirs = (
+        scan_tree(root_dir).build_dirs
+        if name == CMAKE_BUILD_DIR
+        else [str(path) for path in Path(root_dir).glob(f"**/{name}")]
+    )
+    if not matching_dirs:
+        return
+    with ThreadPoolExecutor(
+        max_workers=min(32, len(matching_dirs))
+    ) as executor:
+        list(executor.map(_remove_directory, matching_dirs))
+
+
+def _shared_tree_digest(tests_directory):
+    """Hash the state of the shared tree every test links against.
+
+    Each test pulls the whole HAL in through its MBED_PATH
+    add_subdirectory, so an edit under hal/ or bootstrap/ must
+    invalidate every recorded test digest. File sizes and mtimes stand
+    in for content here - the same signal ninja trusts - since reading
+    the full tree on every run would cost more than the skips save.
+    """
+    tests_root = str(Path(tests_directory).absolute())
+    repo_root = Path(tests_root).parent
+    digest = hashlib.blake2b()
+    stack = [str(repo_root)]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.path):
+                if entry.is_dir(follow_symlinks=False):
+                    if (
+                        entry.name in (".git", CMAKE_BUILD_DIR)
+                        or entry.path == tests_root
+                    ):
+                        continue
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat_result = entry.stat()
+                    relative_name = os.path.relpath(entry.path, repo_root)
+                    digest.update(
+                        f"{relative_name}\0{stat_result.st_size}"
+                        f"\0{stat_result.st_mtime_ns}\0".encode()
+                    )
+    return digest.hexdigest()
+
+
+def _test_directory_digest(test_dir, toolchain, profile, tree_digest=""):
+    """Hash a test directory's files together with the build flavour.
+
+    Each file contributes its path relative to the test directory and
+    its size ahead of its content, so renames, moves between
+    subdirectories and content shifted across file boundaries all
+    change the digest. The shared-tree digest is folded in so the
+    out-of-tree sources the test links against invalidate it too.
+    """
+    digest = hashlib.blake2b(f"{toolchain}:{profile}:{tree_digest}".encode())
+    source_files = sorted(
+        path
+        for path in Path(test_dir).rglob("*")
+        if path.is_file() and CMAKE_BUILD_DIR not in path.parts
+    )
+    for source_file in source_files:
+        relative_name = source_file.relative_to(test_dir).as_posix()
+        digest.update(
+            f"{relative_name}\0{source_file.stat().st_size}\0".encode()
+        )
+        with open(source_file, "rb") as source:
+            for chunk in iter(lambda: source.read(1 << 16), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _has_test_binary(build_dir):
+    """Check whether a build directory holds a previously built binary."""
+    return build_dir.is_dir() and any(
+        _TEST_BINARY_RE.match(path.name) for path in build_dir.rglob("*.bin")
+    )
+
+
+def _load_build_cache(tests_directory):
+    """Load the recorded digests of previously built test directories."""
+    try:
+        with open(Path(tests_directory, BUILD_CACHE_FILE)) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_build_cache(tests_directory, build_cache):
+    """Record the digests of the test directories built successfully."""
+    with open(Path(tests_directory, BUILD_CACHE_FILE), "w") as cache_file:
+        json.dump(build_cache, cache_file, indent=2, sort_keys=True)
+
+
+async def _execute_async(cmd, env=None):
+    """Run a command, forwarding its output to stdout line by line.
+
+    The pipe is drained in chunks and re-split on newlines rather than
+    iterated with the StreamReader line API, which caps a line at the
+    64 KiB stream limit; ninja echoes the full failing command and a
+    link line for these tests can exceed that.
+    """
+    log.debug("command: '%s'", cmd)
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, env=_child_environment(env)
+    )
+    buffer = b""
+    while True:
+        data = await process.stdout.read(1 << 16)
+        if not data:
+            break
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            sys.stdout.buffer.write(line + b"\n")
+    if buffer:
+        sys.stdout.buffer.write(buffer + b"\n")
+    sys.stdout.buffer.flush()
+    return_code = await process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, cmd)
+
+
+async def _build_one_test(
+    args, cmake_list_file, build_jobs, semaphore, build_cache, tree_digest
+):
+    """Configure and build a single test directory."""
+    async with semaphore:
+        test_dir = Path(cmake_list_file).parent
+        build_dir = test_dir.joinpath(CMAKE_BUILD_DIR)
+        cache_key = str(test_dir.relative_to(args.tests_directory))
+        digest = _test_directory_digest(
+            test_dir, args.toolchain, args.profile, tree_digest
+        )
+        if (
+            not args.force_reconfigure
+            and build_cache.get(cache_key) == digest
+            and _has_test_binary(build_dir)
+        ):
+            log.debug("Sources unchanged, skipping: %s", test_dir)
+            return
+        if args.force_reconfigure or not cmake_cache_matches(
+            build_dir, args.toolchain, args.profile
+        ):
+            cmd, env = _configure_invocation(
+                test_dir,
+                build_dir,
+                args.toolchain,
+                args.profile,
+                cache_base_dir=args.tests_directory,
+            )
+            compiler_id_cache_dir = _compiler_id_cache_dir(
+                args.tests_directory, args.toolchain, args.profile
+            )
+            _prime_compiler_id_results(build_dir, compiler_id_cache_dir)
+            await _execute_async(cmd, env=env)
+            _store_compiler_id_results(build_dir, compiler_id_cache_dir)
+        else:
+            log.debug("Reusing CMake cache: %s", test_dir)
+        await _execute_async(_build_invocation(build_dir, build_jobs))
+        build_cache[cache_key] = digest
+
+
+async def _build_all_tests(args, cmake_list_files):
+    """Build every test directory, at most args.jobs at a time.
+
+    The job budget is split between the two levels of parallelism:
+    with N directories building concurrently each inner cmake --build
+    gets jobs/N compiler processes, rather than jobs per directory
+    multiplying out to jobs**2 overall.
+    """
+    directory_concurrency = max(1, min(args.jobs, len(cmake_list_files)))
+    build_jobs = max(1, args.jobs // directory_concurrency)
+    semaphore = asyncio.Semaphore(directory_concurrency)
+    build_cache = _load_build_cache(args.tests_directory)
+    tree_digest = _shared_tree_digest(args.tests_directory)
+    try:
+        await asyncio.gather(
+            *[
+                _build_one_test(
+                    args,
+                    cmake_list_file,
+                    build_jobs,
+                    semaphore,
+                    build_cache,
+                    tree_digest,
+                )
+                for cmake_list_file in cmake_list_files
+            ]
+        )
+    finally:
+        # Keep the digests of whatever did build so an aborted run
+        # still skips those directories next time.
+        _store_build_cache(args.tests_directory, build_cache)
+
+
+def _is_standalone_test(cmake_list_file):
+    """Check whether a CMakeLists defines a buildable Greentea project.
+
+    Some test directories only hold fragments (object libraries picked
+    up by a parent suite); they reference targets that are undefined
+    outside that suite and cannot be configured on their own.
+    """
+    try:
+        content = Path(cmake_list_file).read_text(errors="replace")
+    except OSError:
+        return False
+    return "mbed_greentea_add_test" in content
+
+
+def _write_superbuild_cmake_lists(tests_directory, cmake_list_files):
+    """Generate a temporary top-level CMakeLists.txt aggregating the tests.
+
+    Only standalone test projects are included; the caller is expected
+    to delete the generated file once the build has finished.
+    """
+    tests_root = Path(tests_directory)
+    lines = [
+        "# Generated by test_helper.py - do not edit.",
+        "cmake_minimum_required(VERSION 3.19.0)",
+        "project(greentea-all)",
+    ]
+    for cmake_list_file in cmake_list_files:
+        if not _is_standalone_test(cmake_list_file):
+            log.debug("Not a standalone test, skipping: %s", cmake_list_file)
+            continue
+        test_dir = Path(cmake_list_file).parent.relative_to(tests_root)
+        lines.append(f"add_subdirectory({test_dir.as_posix()})")
+    superbuild_cmake_lists = tests_root.joinpath("CMakeLists.txt")
+    superbuild_cmake_lists.write_text("\n".join(lines) + "\n")
+    return superbuild_cmake_lists
+
+
+def build_all_tests_action(args):
+    """Entry point for building all the Greentea tests."""
+    tests_root = Path(args.tests_directory)
+    cmake_list_files = [
+        cmake_list_file
+        for cmake_list_file in scan_tree(tests_root).cmake_lists
+        if Path(cmake_list_file).parent != tests_root
+    ]
+
+    if args.superbuild:
+        # Configure once for the whole tree: the toolchain detection and
+        # try_compile probes run a single time and the generator sees the
+        # full dependency graph across every test.
+        superbuild_cmake_lists = _write_superbuild_cmake_lists(
+            args.tests_directory, cmake_list_files
+        )
+        try:
+            if args.force_reconfigure or not cmake_cache_matches(
+                tests_root.joinpath(CMAKE_BUILD_DIR),
+                args.toolchain,
+                args.profile,
+            ):
+                run_configure_build_cmd(
+                    args.tests_directory,
+                    args.toolchain,
+                    args.profile,
+                    cache_base_dir=args.tests_directory,
+                )
+            run_build_cmd(args.tests_directory, args.jobs)
+        finally:
+            superbuild_cmake_lists.unlink()
+        return
+
+    # One event loop overlaps the configure and build children without
+    # a process pool's fork and pickling cost: the interpreter only
+    # relays their output while they do the heavy lifting.
+    asyncio.run(_build_all_tests(args, cmake_list_files))
+
+
+@functools.lru_cache(maxsize=None)
+def mbedhtrun_supports_batch():
+    """Check whether the installed mbedhtrun accepts batched image paths."""
+    try:
+        help_text = subprocess.run(
+            ["mbedhtrun", "--help"], capture_output=True, text=True
+        ).stdout
+    except OSError:
+        return False
+    return "batch" in help_text
+
+
+def _spawn_persistent_runner(port, disk, binaries):
+    """Start one long-lived mbedhtrun fed every binary over stdin.
+
+    The serial port is opened and the host-test bootstrap run once per
+    device instead of once per binary; the runner flashes each image
+    path it reads from its input. The paths are written from a helper
+    thread: writing them all up front from the selector loop would
+    deadlock once the list outgrows the pipe capacity while the child
+    blocks on its own unread stdout.
+    """
+    cmd = ["mbedhtrun", "-d", disk, "-p", port]
+    log.debug("command: '%s'", cmd)
+    popen = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        bufsize=0,
+        env=_child_environment(),
+    )
+
+    def feed_stdin():
+        try:
+            with popen.stdin:
+                for binary in binaries:
+                    popen.stdin.write(f"{binary}\n".encode())
+        except BrokenPipeError:
+            # The runner exited early; its return code is reported by
+            # the selector loop.
+            pass
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    return popen, cmd
+
+
+def _multiplex_board_runs(boards, binaries, persistent=False):
+    """Run each board's share of the binaries, one child per board.
+
+    A selector (epoll on Linux) watches every running child's stdout
+    from this one thread; whichever pipe has data is drained, its
+    lines printed under the board's port prefix, and a child that
+    exits cleanly is replaced at once by its board's next binary.
+    In persistent mode each board gets a single long-lived child that
+    takes its whole share up front.
+    """
+    selector = selectors.DefaultSelector()
+    pending = {
+        board: list(reversed(binaries[index :: len(boards)]))
+        for index, board in enumerate(boards)
+    }
+    buffers = {}
+    failures = []
+
+    def start_next(board):
+        port, disk = board
+        if not pending[board]:
+            return
+        if persistent:
+            # pending is kept pop()-ordered; undo that for the batch.
+            popen, cmd = _spawn_persistent_runner(
+                port, disk, pending[board][::-1]
+            )
+            pending[board] = []
+        else:
+            binary = pending[board].pop()
+            cmd = ["mbedhtrun", "-d", disk, "-p", port, "-f", str(binary)]
+            log.debug("command: '%s'", cmd)
+            popen = _spawn(cmd)
+        selector.register(
+            popen.stdout, selectors.EVENT_READ, (popen, board, cmd)
+        )
+
+    for board in boards:
+        start_next(board)
+
+    while selector.get_map():
+        for key, _ in selector.select():
+            popen, board, cmd = key.data
+            port = board[0]
+            data = os.read(key.fd, 1 << 16)
+            if data:
+                *lines, buffers[key.fd] = (
+                    buffers.get(key.fd, b"") + data
+                ).split(b"\n")
+                for line in lines:
+                    print(f"[{port}] {line.decode(errors='replace')}")
+            else:
+                leftover = buffers.pop(key.fd, b"")
+                if leftover:
+                    print(f"[{port}] {leftover.decode(errors='replace')}")
+                selector.unregister(key.fileobj)
+                popen.stdout.close()
+                return_code = popen.wait()
+                if return_code:
+                    # Leave this board idle; keep the others running.
+                    failures.append(
+                        subprocess.CalledProcessError(return_code, cmd)
+                    )
+                    if pending[board]:
+                        log.warning(
+                            "Not running %d remaining binaries on %s: %s",
+                            len(pending[board]),
+                            port,
+                            ", ".join(
+                                str(binary)
+                                for binary in reversed(pending[board])
+                            ),
+                        )
+                        pending[board] = []
+                else:
+                    start_next(board)
+
+    if failures:
+        for failure in failures:
+            log.error("Test run failed: %s", failure)
+        raise failures[0]
+
+
+def run_all_tests_action(args):
+    """Entry point for running all the Greentea tests."""
+    if len(args.port) != len(args.disk):
+        raise ValueError(
+            "The same number of --port and --disk values must be given."
+        )
+
+    binaries = sorted(scan_tree(args.tests_directory).binaries)
+    boards = list(zip(args.port, args.disk))
+
+    persistent = args.persistent_runner and mbedhtrun_supports_batch()
+    if args.persistent_runner and not persistent:
+        log.warning(
+            "mbedhtrun does not support batch input;"
+            " running one invocation per binary."
+        )
+
+    if len(boards) == 1 and not persistent:
+        port, disk = boards[0]
+        for binary in binaries:
+            cmd = ["mbedhtrun", "-d", disk, "-p", port, "-f", str(binary)]
+            log.debug("command: '%s'", cmd)
+            execute_forward(cmd)
+        return
+
+    # Flashing and serial I/O spend most of their wall time blocked, so
+    # one runner per device overlaps the boards. Each board still runs
+    # its share of the binaries one at a time.
+    _multiplex_board_runs(boards, binaries, persistent=persistent)
+
+
+def clean_all_tests_action(args):
+    """Entry point for removing all the Greentea test build directories."""
+    remove_subdirectories_with_name(args.tests_directory, CMAKE_BUILD_DIR)
+
+
+def parse_args():
+    """Parse the command line args."""
+    parser = ArgumentParserWithDefaultHelp(
+        description="Greentea tests helper",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--tests-directory",
+        default=str(Path(__file__).absolute().parents[2].joinpath("tests")),
+        help="Path to the root of the Greentea tests tree.",
+    )
+
+    subparsers = parser.add_subparsers(title="actions")
+
+    build_all = subparsers.add_parser(
+        "build_all", help="Build all the Greentea tests."
+    )
+    build_all.add_argument(
+        "-t",
+        "--toolchain",
+        required=True,
+        choices=["ARM", "GCC_ARM"],
+        help="Toolchain to build the tests with.",
+    )
+    build_all.add_argument(
+        "-p",
+        "--profile",
+        default="develop",
+        help="Build profile to build the tests with.",
+    )
+    build_all.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=default_jobs(),
+        help=(
+            "Number of test directories to configure and build in"
+            " parallel, and of compiler jobs within each build."
+        ),
+    )
+    build_all.add_argument(
+        "-s",
+        "--superbuild",
+        action="store_true",
+        help=(
+            "Generate a single top-level CMakeLists.txt aggregating every"
+            " test and configure and build it once, instead of configuring"
+            " each test directory separately."
+        ),
+    )
+    build_all.add_argument(
+        "-f",
+        "--force-reconfigure",
+        action="store_true",
+        help=(
+            "Re-run the CMake configure and build steps even when the"
+            " recorded sources digest and an existing build directory"
+            " already match the requested toolchain and profile."
+        ),
+    )
+    build_all.set_defaults(func=build_all_tests_action)
+
+    run_all = subparsers.add_parser(
+        "run_all", help="Run all the Greentea tests."
+    )
+    run_all.add_argument(
+        "-p",
+        "--port",
+        required=True,
+        nargs="+",
+        help=(
+            "Serial port of the device under test. Give several to run"
+            " the tests across multiple devices concurrently."
+        ),
+    )
+    run_all.add_argument(
+        "-d",
+        "--disk",
+        required=True,
+        nargs="+",
+        help=(
+            "Mount point of the device under test. Give one per --port"
+            " value, in the same order."
+        ),
+    )
+    run_all.add_argument(
+        "-r",
+        "--persistent-runner",
+        action="store_true",
+        help=(
+            "Keep one mbedhtrun running per device and stream the test"
+            " binaries to it, instead of re-opening the serial port for"
+            " every binary. Requires an mbedhtrun with batch support;"
+            " falls back to one invocation per binary without it."
+        ),
+    )
+    run_all.set_defaults(func=run_all_tests_action)
+
+    clean_all = subparsers.add_parser(
+        "clean_all", help="Remove all the Greentea test build directories."
+    )
+    clean_all.set_defaults(func=clean_all_tests_action)
+
+    args_namespace = parser.parse_args()
+
+    # We want to fail gracefully, with a consistent
+    # help message, in the no argument case.
+    # So here's an obligatory hasattr hack.
+    if not hasattr(args_namespace, "func"):
+        parser.error("No arguments given!")
+    else:
+        return args_namespace
+
+
+def run_helper():
+    """Application main algorithm."""
+    args = parse_args()
+    args.func(args)
+
+
+def _main():
+    """Run the Greentea tests helper."""
+    try:
+        run_helper()
+    except Exception as error:
+        print(error)
+        return ReturnCode.ERROR.value
+    else:
+        return ReturnCode.SUCCESS.value
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
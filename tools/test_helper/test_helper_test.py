@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2021 ARM Limited
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+
+from test_helper import *
+from test_helper import _shared_tree_digest, _test_directory_digest
+
+
+def test_cmake_cache_matches_ignores_entry_type(tmp_path):
+    tmp_path.joinpath("CMakeCache.txt").write_text(
+        "# This is the CMakeCache file.\n"
+        "CMAKE_BUILD_TYPE:STRING=develop\n"
+        "MBED_TOOLCHAIN:UNINITIALIZED=GCC_ARM\n"
+    )
+
+    assert cmake_cache_matches(tmp_path, "GCC_ARM", "develop")
+    assert not cmake_cache_matches(tmp_path, "ARM", "develop")
+    assert not cmake_cache_matches(tmp_path, "GCC_ARM", "release")
+
+
+def test_cmake_cache_matches_without_cache_file(tmp_path):
+    assert not cmake_cache_matches(tmp_path, "GCC_ARM", "develop")
+
+
+def test_test_directory_digest_sees_moved_files(tmp_path):
+    tmp_path.joinpath("sub").mkdir()
+    source_file = tmp_path.joinpath("main.cpp")
+    source_file.write_text("int main() {}")
+
+    before = _test_directory_digest(tmp_path, "GCC_ARM", "develop")
+    source_file.rename(tmp_path.joinpath("sub", "main.cpp"))
+    after = _test_directory_digest(tmp_path, "GCC_ARM", "develop")
+
+    assert before != after
+
+
+def test_shared_tree_digest_sees_out_of_tree_changes(tmp_path):
+    tests_dir = tmp_path.joinpath("tests")
+    tests_dir.mkdir()
+    tmp_path.joinpath("hal").mkdir()
+    hal_source = tmp_path.joinpath("hal", "ticker_api.c")
+    hal_source.write_text("int hal_ticker;")
+
+    before = _shared_tree_digest(tests_dir)
+    hal_source.write_text("int hal_ticker_changed;")
+    after = _shared_tree_digest(tests_dir)
+
+    assert before != after
+    tests_dir.joinpath("main.cpp").write_text("int main() {}")
+    assert _shared_tree_digest(tests_dir) == after
+
+
+def test_test_directory_digest_folds_in_tree_digest(tmp_path):
+    tmp_path.joinpath("main.cpp").write_text("int main() {}")
+
+    assert _test_directory_digest(
+        tmp_path, "GCC_ARM", "develop", "one"
+    ) != _test_directory_digest(tmp_path, "GCC_ARM", "develop", "other")
+
+
+def test_clean_all_removes_build_directories(tmp_path):
+    build_dir = tmp_path.joinpath("crc", "cmake_build")
+    build_dir.mkdir(parents=True)
+    build_dir.joinpath("CMakeCache.txt").write_text("")
+    other_file = tmp_path.joinpath("crc", "main.cpp")
+    other_file.write_text("")
+
+    args = argparse.Namespace(tests_directory=str(tmp_path))
+    clean_all_tests_action(args)
+
+    assert not build_dir.exists()
+    assert other_file.exists()